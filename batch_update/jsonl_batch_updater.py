@@ -3,6 +3,7 @@ from pathlib import Path
 import os
 import shutil
 import mmap
+from io import StringIO
 
 # 添加项目根目录到sys.path
 project_root = Path(__file__).parent.parent
@@ -51,6 +52,27 @@ BATCH_MARK_SIZE = 100000  # 批量标记is_done的批次大小（增大以减少
                           # 更大值 = 更少提交 = 更快，但崩溃时丢失更多未提交标记
                           # 对于6700万记录，500000可以减少到约134次提交
 
+# 会话级参数
+SESSION_SETTINGS = [
+    "SET work_mem = '256MB'",
+]
+
+# 只在分组聚合查询期间生效的并行参数（查询前 SET、取完结果后 RESET），
+# 避免 parallel_setup_cost = 0 让逐文件的预编译点查也走并行计划
+GROUPED_QUERY_PARALLEL_SETTINGS = {
+    "max_parallel_workers_per_gather": "8",
+    "parallel_setup_cost": "0",
+    "parallel_tuple_cost": "0.01",
+}
+GROUPED_QUERY_SET_SQL = "; ".join(f"SET {k} = {v}" for k, v in GROUPED_QUERY_PARALLEL_SETTINGS.items())
+GROUPED_QUERY_RESET_SQL = "; ".join(f"RESET {k}" for k in GROUPED_QUERY_PARALLEL_SETTINGS)
+
+# 批量标记 is_done 时，corpusid 先 COPY 进该会话临时表再 JOIN 更新（替代超大 ANY(%s) 数组参数）
+DONE_IDS_TABLE = "_done_ids"
+
+# 按文件获取更新数据的预编译语句（每个连接 PREPARE 一次，逐文件 EXECUTE，避免重复解析/规划）
+FILE_UPDATES_STMT = "file_updates"
+
 # 初始化
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 LOCAL_TEMP_DIR.mkdir(parents=True, exist_ok=True)
@@ -163,6 +185,15 @@ class JSONLBatchUpdater:
             try:
                 conn = psycopg2.connect(**db_config)
                 cursor = conn.cursor()
+                for setting in SESSION_SETTINGS:
+                    cursor.execute(setting)
+                cursor.execute(f"""
+                    PREPARE {FILE_UPDATES_STMT} (bigint[]) AS
+                    SELECT corpusid, specter_v1, specter_v2, content, "citations", "references"
+                    FROM {TEMP_TABLE}
+                    WHERE corpusid = ANY($1) AND is_done = FALSE;
+                """)
+                conn.commit()  # 提交后 SET 在整个会话内生效
                 return machine_id, conn, cursor, None
             except OperationalError as e:
                 if attempt < MAX_RETRIES - 1:
@@ -256,6 +287,28 @@ class JSONLBatchUpdater:
         if not primary_cursor.fetchone()[0]:
             raise RuntimeError("映射表 corpusid_to_file 不存在！需要先创建该表。")
         
+        # 确保 corpusid_to_file 的 JOIN 键 corpusid 有索引（已有以 corpusid 开头的索引/主键则跳过）
+        for machine_id in self.machine_list:
+            cursor = self.cursors[machine_id]
+            conn = self.connections[machine_id]
+            
+            cursor.execute("SELECT to_regclass('corpusid_to_file');")
+            if cursor.fetchone()[0] is None:
+                continue
+            
+            cursor.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_index i
+                    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                    WHERE i.indrelid = 'corpusid_to_file'::regclass AND a.attname = 'corpusid'
+                );
+            """)
+            if not cursor.fetchone()[0]:
+                print(f"\n  [{machine_id}] corpusid_to_file.corpusid 缺少索引，正在创建...", end='', flush=True)
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_corpusid_to_file_corpusid ON corpusid_to_file (corpusid);")
+                cursor.execute("ANALYZE corpusid_to_file;")
+            conn.commit()
+        
         elapsed = time.time() - start_ts
         log_performance("创建索引", machines=','.join(self.machine_list), time_sec=f"{elapsed:.2f}")
         
@@ -272,30 +325,36 @@ class JSONLBatchUpdater:
         
         if self.mode == 'single':
             # 单机器模式（向后兼容）
+            # 客户端游标：结果只有 文件数 行且会全部读入 grouped；命名游标（DECLARE CURSOR）不会使用并行计划
             cursor = self.cursors[self.primary_machine]
             
-            # 修改：添加 content 字段查询，并按 content 是否为空排序（非空优先）
+            # 在数据库端按文件分组聚合（只返回 文件数 行，而不是逐条记录）
+            # content 非空优先：文件内按优先级排序，有 content 的文件排在前面
+            cursor.execute(GROUPED_QUERY_SET_SQL)
             cursor.execute(f"""
                 SELECT 
                     m.batch_filename,
-                    t.corpusid,
-                    CASE WHEN t.content IS NOT NULL AND t.content != '' THEN 0 ELSE 1 END as has_content_priority
+                    array_agg(t.corpusid ORDER BY
+                        CASE WHEN t.content IS NOT NULL AND t.content != '' THEN 0 ELSE 1 END) as corpusids
                 FROM {TEMP_TABLE} t
                 INNER JOIN corpusid_to_file m ON t.corpusid = m.corpusid
                 WHERE t.is_done = FALSE
-                ORDER BY has_content_priority ASC;
+                GROUP BY m.batch_filename
+                ORDER BY MIN(CASE WHEN t.content IS NOT NULL AND t.content != '' THEN 0 ELSE 1 END) ASC;
             """)
+            rows = cursor.fetchall()
+            cursor.execute(GROUPED_QUERY_RESET_SQL)
             
             sql_time = time.time() - sql_start
             
-            # 按文件名分组（只存corpusid列表）
+            # 直接构造 {文件名: corpusid列表}
             group_start = time.time()
-            grouped = defaultdict(list)
+            grouped = {}
             total_count = 0
             
-            for batch_filename, corpusid, has_content_priority in cursor:
-                grouped[batch_filename].append(corpusid)
-                total_count += 1
+            for batch_filename, corpusids in rows:
+                grouped[batch_filename] = corpusids
+                total_count += len(corpusids)
             
             group_time = time.time() - group_start
             log_performance("SQL查询", time_sec=f"{sql_time:.2f}", records=total_count)
@@ -314,6 +373,7 @@ class JSONLBatchUpdater:
                 
                 # 使用 GROUP BY 在数据库端聚合，只返回 (filename, array[corpusids])
                 # 这样可以将 4000万行 → 2000个文件，数据量减少 20000 倍！
+                cursor.execute(GROUPED_QUERY_SET_SQL)
                 cursor.execute(f"""
                     SELECT 
                         m.batch_filename,
@@ -323,11 +383,13 @@ class JSONLBatchUpdater:
                     WHERE t.is_done = FALSE
                     GROUP BY m.batch_filename;
                 """)
+                rows = cursor.fetchall()
+                cursor.execute(GROUPED_QUERY_RESET_SQL)
                 
                 # 快速构造结果（只有几千个文件，而不是4000万条记录）
                 file_corpusids = {}
                 total_records = 0
-                for batch_filename, corpusids in cursor:
+                for batch_filename, corpusids in rows:
                     file_corpusids[batch_filename] = corpusids
                     total_records += len(corpusids)
                 
@@ -352,22 +414,24 @@ class JSONLBatchUpdater:
             
             # 快速合并结果（优化：假设数据基本不重叠，大幅简化逻辑）
             group_start = time.time()
-            grouped = defaultdict(list)
+            grouped = {}
             total_count = 0
             overlap_files = set()
             
             # 直接合并，不检查重复（因为 machine0 只有 specter_v2，machine2 只有 specter_v1）
             # 如果有重复，在后续处理时自动合并
             for machine_id, file_corpusids in machine_results.items():
+                # 同一机器的所有记录共享一个来源列表（后续只读，合并重叠时会新建列表）
+                sources = [machine_id]
                 for filename, corpusids in file_corpusids.items():
-                    # 检查该文件是否在其他机器上也有（用于统计重叠）
-                    if grouped[filename]:  # 如果已经有数据，说明有重叠
-                        overlap_files.add(filename)
+                    total_count += len(corpusids)
                     
-                    # 直接添加数据（每个 corpusid 标记来源机器）
-                    for corpusid in corpusids:
-                        grouped[filename].append((corpusid, [machine_id]))
-                        total_count += 1
+                    # 按文件整体构造 (corpusid, sources) 列表，而不是逐条 append
+                    if filename in grouped:  # 如果已经有数据，说明有重叠
+                        overlap_files.add(filename)
+                        grouped[filename].extend([(cid, sources) for cid in corpusids])
+                    else:
+                        grouped[filename] = [(cid, sources) for cid in corpusids]
             
             # 如果有重叠文件，需要合并相同 corpusid 的 sources
             if overlap_files:
@@ -419,11 +483,7 @@ class JSONLBatchUpdater:
             # 单机器模式：查询所有字段（与多机器模式统一）
             cursor = self.cursors[self.primary_machine]
             
-            cursor.execute(f"""
-                SELECT corpusid, specter_v1, specter_v2, content, "citations", "references"
-                FROM {TEMP_TABLE}
-                WHERE corpusid = ANY(%s) AND is_done = FALSE;
-            """, (corpusid_list_or_tuples,))
+            cursor.execute(f"EXECUTE {FILE_UPDATES_STMT}(%s::bigint[]);", (corpusid_list_or_tuples,))
             
             # 构造与多机器模式相同的返回格式
             updates_merged = {}
@@ -481,12 +541,8 @@ class JSONLBatchUpdater:
                 
                 cursor = self.cursors[machine_id]
                 
-                # 查询所有字段（只返回非空字段）
-                cursor.execute(f"""
-                    SELECT corpusid, specter_v1, specter_v2, content, "citations", "references"
-                    FROM {TEMP_TABLE}
-                    WHERE corpusid = ANY(%s) AND is_done = FALSE;
-                """, (corpusids,))
+                # 查询所有字段（预编译语句）
+                cursor.execute(f"EXECUTE {FILE_UPDATES_STMT}(%s::bigint[]);", (corpusids,))
                 
                 # Step 3: 合并数据（处理冲突）
                 for corpusid, specter_v1, specter_v2, content, citations, references in cursor:
@@ -545,22 +601,26 @@ class JSONLBatchUpdater:
             return updates_merged
     
     @staticmethod
-    def _extract_corpusid(line: bytes) -> int | None:
-        """从JSONL行快速提取corpusid（避免完整JSON解析）"""
+    def _extract_corpusid(line, start: int = 0, end: int | None = None) -> int | None:
+        """从JSONL行快速提取corpusid（避免完整JSON解析）
+        
+        line 可以是 bytes 或 mmap，[start, end) 为行所在范围（在 mmap 上查找无需先切出整行）
+        """
+        line_end = len(line) if end is None else end
         # 查找 "corpusid": 后的数字
-        idx = line.find(b'"corpusid"')
+        idx = line.find(b'"corpusid"', start, line_end)
         if idx == -1:
             return None
-        idx = line.find(b":", idx)
+        idx = line.find(b":", idx, line_end)
         if idx == -1:
             return None
         idx += 1
         # 跳过空格
-        while idx < len(line) and line[idx:idx+1] in b" \t":
+        while idx < line_end and line[idx:idx+1] in b" \t":
             idx += 1
         # 提取数字
         end = idx
-        while end < len(line) and line[end:end+1].isdigit():
+        while end < line_end and line[end:end+1].isdigit():
             end += 1
         if end == idx:
             return None
@@ -707,54 +767,48 @@ class JSONLBatchUpdater:
             win32file.CopyFile(str(file_path), str(local_cache), 0)
             copy_in_time = time.time() - t0
         
-        # 步骤2: 处理文件（优化：一次性读取，减少 I/O 次数）
+        # 步骤2: 处理文件（mmap 映射输入，只解析需要更新的行）
         t0 = time.time()
         
-        # 预编译更新字典的键集合，加速查找
-        updates_keys = set(updates.keys())
         updated_corpusids = []
         
-        # 一次性读取整个文件（现代计算机内存足够，比流式读写快得多）
-        with open(local_cache, 'rb') as fin:
-            content = fin.read()
-        
-        # 按行分割
-        lines = content.split(b'\n')
-        has_trailing_newline = content.endswith(b'\n')
-        output_lines = []
-        
-        # 批量处理所有行（在内存中，非常快）
-        for line in lines:
-            if not line:
-                output_lines.append(b'')
-                continue
-            
-            corpusid = self._extract_corpusid(line)
-            
-            if corpusid in updates_keys:
-                # 需要更新
-                try:
-                    record = orjson.loads(line)
-                    data = updates[corpusid]
+        # 在 mmap 上按 '\n' 定位行并直接查找 corpusid（不切分整个文件、不复制未改动的行），
+        # 未改动的区间按原字节整段写出，只有更新的行被替换
+        with open(local_cache, 'rb') as fin, open(local_output, 'wb') as fout:
+            size = os.fstat(fin.fileno()).st_size
+            if size:
+                with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    if hasattr(mm, 'madvise'):  # Windows 下无 madvise
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
                     
-                    # 应用更新
-                    if self._apply_update(record, data):
-                        updated_corpusids.append(corpusid)
-                        output_lines.append(orjson.dumps(record))
-                    else:
-                        output_lines.append(line)
-                except Exception:
-                    # JSON 解析失败，保留原样
-                    output_lines.append(line)
-            else:
-                # 不需要更新
-                output_lines.append(line)
-        
-        # 一次性写入（减少 I/O 次数）
-        with open(local_output, 'wb') as fout:
-            fout.write(b'\n'.join(output_lines))
-            if has_trailing_newline and output_lines:
-                fout.write(b'\n')
+                    written = 0  # 已写出到 fout 的位置
+                    pos = 0      # 当前行起点
+                    while pos < size:
+                        end = mm.find(b'\n', pos)
+                        if end == -1:
+                            end = size
+                        
+                        corpusid = self._extract_corpusid(mm, pos, end)
+                        
+                        if corpusid in updates:  # dict 本身即哈希查找，无需再复制一份键集合
+                            # 需要更新
+                            try:
+                                record = orjson.loads(mm[pos:end])
+                                
+                                # 应用更新
+                                if self._apply_update(record, updates[corpusid]):
+                                    new_line = orjson.dumps(record)
+                                    fout.write(view[written:pos])
+                                    fout.write(new_line)
+                                    written = end
+                                    updated_corpusids.append(corpusid)
+                            except Exception:
+                                # JSON 解析失败，保留原样
+                                pass
+                        
+                        pos = end + 1
+                    
+                    fout.write(view[written:size])
         
         process_time = time.time() - t0
         
@@ -778,10 +832,32 @@ class JSONLBatchUpdater:
                 updates=len(updated_corpusids)
             )
         
-        failed = [cid for cid in updates.keys() if cid not in updated_corpusids]
+        updated_set = set(updated_corpusids)  # 集合成员判断，避免对每个 corpusid 线性扫描列表
+        failed = [cid for cid in updates.keys() if cid not in updated_set]
         return (len(updated_corpusids), failed)
     
     
+    def _record_failed(self, filename, failed):
+        """记录失败的corpusid（拼接后一次性写入失败日志）"""
+        self.failed_corpusids.extend(failed)
+        with open(FAILED_LOG, 'a', encoding='utf-8') as f:
+            f.write("".join(f"{cid}\t{filename}\tFAILED\n" for cid in failed))
+    
+    @staticmethod
+    def _update_done(cursor, corpusids):
+        """通过 COPY 临时表批量标记 is_done（不提交）"""
+        cursor.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS {DONE_IDS_TABLE} (corpusid BIGINT) ON COMMIT DELETE ROWS;
+        """)
+        buffer = StringIO("\n".join(map(str, corpusids)) + "\n")
+        cursor.copy_from(buffer, DONE_IDS_TABLE, columns=('corpusid',))
+        cursor.execute(f"""
+            UPDATE {TEMP_TABLE} t
+            SET is_done = TRUE
+            FROM {DONE_IDS_TABLE} d
+            WHERE t.corpusid = d.corpusid
+        """)
+    
     def mark_as_done(self, corpusids_or_dict):
         """标记corpusid为已处理（支持多机器模式）
         
@@ -799,12 +875,7 @@ class JSONLBatchUpdater:
             cursor = self.cursors[self.primary_machine]
             conn = self.connections[self.primary_machine]
             
-            cursor.execute(f"""
-                UPDATE {TEMP_TABLE} 
-                SET is_done = TRUE 
-                WHERE corpusid = ANY(%s)
-            """, (corpusids_or_dict,))
-            
+            self._update_done(cursor, corpusids_or_dict)
             conn.commit()
             elapsed = time.time() - t0
             log_performance("数据库更新", records=len(corpusids_or_dict), time_sec=f"{elapsed:.2f}")
@@ -827,12 +898,7 @@ class JSONLBatchUpdater:
                 cursor = self.cursors[machine_id]
                 conn = self.connections[machine_id]
                 
-                cursor.execute(f"""
-                    UPDATE {TEMP_TABLE} 
-                    SET is_done = TRUE 
-                    WHERE corpusid = ANY(%s)
-                """, (corpusids,))
-                
+                self._update_done(cursor, corpusids)
                 conn.commit()
                 total_records += len(corpusids)
             
@@ -941,11 +1007,12 @@ class JSONLBatchUpdater:
                             
                             total_success += success_count
                             total_failed += len(failed)
+                            failed_set = frozenset(failed)  # 下面逐个 corpusid 判断是否失败，用集合查找
                             
                             # 累积待标记的记录（批量标记优化）
                             if self.mode == 'single':
                                 # 单机器模式：累积corpusid
-                                success_ids = [cid for cid in updates.keys() if cid not in failed]
+                                success_ids = [cid for cid in updates.keys() if cid not in failed_set]
                                 pending_marks_single.extend(success_ids)
                                 
                                 # 达到批次大小则批量标记
@@ -955,7 +1022,7 @@ class JSONLBatchUpdater:
                             else:
                                 # 多机器模式：累积 {corpusid: sources}
                                 for corpusid, sources in corpusid_list_or_tuples:
-                                    if corpusid not in failed:
+                                    if corpusid not in failed_set:
                                         pending_marks_multi[corpusid] = sources
                                 
                                 # 达到批次大小则批量标记
@@ -965,10 +1032,7 @@ class JSONLBatchUpdater:
                             
                             # 记录失败的corpusid
                             if failed:
-                                self.failed_corpusids.extend(failed)
-                                with open(FAILED_LOG, 'a', encoding='utf-8') as f:
-                                    for cid in failed:
-                                        f.write(f"{cid}\t{filename}\tFAILED\n")
+                                self._record_failed(filename, failed)
                             
                             pbar.update(1)
                         
@@ -1043,11 +1107,12 @@ class JSONLBatchUpdater:
                         
                         total_success += success_count
                         total_failed += len(failed)
+                        failed_set = frozenset(failed)  # 下面逐个 corpusid 判断是否失败，用集合查找
                         
                         # 累积待标记的记录（批量标记优化）
                         if self.mode == 'single':
                             # 单机器模式：累积corpusid
-                            success_ids = [cid for cid in updates.keys() if cid not in failed]
+                            success_ids = [cid for cid in updates.keys() if cid not in failed_set]
                             pending_marks_single.extend(success_ids)
                             
                             # 达到批次大小则批量标记
@@ -1060,7 +1125,7 @@ class JSONLBatchUpdater:
                         else:
                             # 多机器模式：累积 {corpusid: sources}
                             for corpusid, sources in corpusid_list_or_tuples:
-                                if corpusid not in failed:
+                                if corpusid not in failed_set:
                                     pending_marks_multi[corpusid] = sources
                             
                             # 达到批次大小则批量标记
@@ -1071,7 +1136,7 @@ class JSONLBatchUpdater:
                             # 统计各机器的更新数
                             machine_counts = defaultdict(int)
                             for corpusid, sources in corpusid_list_or_tuples:
-                                if corpusid not in failed:
+                                if corpusid not in failed_set:
                                     for machine_id in sources:
                                         machine_counts[machine_id] += 1
                             
@@ -1084,10 +1149,7 @@ class JSONLBatchUpdater:
                         
                         # 记录失败的corpusid
                         if failed:
-                            self.failed_corpusids.extend(failed)
-                            with open(FAILED_LOG, 'a', encoding='utf-8') as f:
-                                for cid in failed:
-                                    f.write(f"{cid}\t{filename}\tFAILED\n")
+                            self._record_failed(filename, failed)
                         
                         pbar.update(1)
             
@@ -5,7 +5,6 @@
 
 import os
 import sys
-import tempfile
 import shutil
 import time
 import sqlite3
@@ -13,6 +12,9 @@ import psycopg2
 from psycopg2 import OperationalError, InterfaceError
 import argparse
 import re
+import queue
+import logging
+import logging.handlers
 from pathlib import Path
 from typing import Dict, Any, Set, Optional
 from datetime import datetime
@@ -31,9 +33,9 @@ from db_config import get_db_config
 
 
 # 需要更新的字段
-CITATION_FIELDS = ["citations", "references", "detailsOfCitations", "detailsOfReference"]
-DB_FIELDS = ["specter_v1", "specter_v2", "content"]
-# DB_FIELDS = ["content"]
+CITATION_FIELDS = ("citations", "references", "detailsOfCitations", "detailsOfReference")
+DB_FIELDS = ("specter_v1", "specter_v2", "content")
+# DB_FIELDS = ("content",)
 ALL_UPDATE_FIELDS = CITATION_FIELDS + DB_FIELDS
 
 ENABLE_DB_LOADING = False
@@ -47,11 +49,42 @@ RETRY_DELAY = 2              # 重试间隔(秒)
 CONNECTION_TIMEOUT = 30      # 连接超时(秒)
 
 
+# 日志：QueueHandler 只负责入队，后台 QueueListener 线程追加写入日志文件（文件句柄常驻，不再每条 open/close）
+logger = logging.getLogger('merge')
+_log_listener = None
+
+
+def setup_logger(log_file: Path):
+    """初始化日志（只写入文件）"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    
+    file_handler = logging.FileHandler(str(log_file), encoding='utf-8', delay=True)
+    file_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _log_listener.start()
+
+
+def shutdown_logger():
+    """停止后台日志线程并刷新剩余日志"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
 def log(log_file: Path, msg: str):
-    """日志只写入文件"""
-    with open(log_file, 'a', encoding='utf-8') as f:
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        f.write(f"[{timestamp}] {msg}\n")
+    """日志只写入文件（首次调用时按 log_file 初始化后台日志线程）"""
+    if _log_listener is None:
+        setup_logger(log_file)
+    logger.info(msg)
 
 
 def clean_json_line(line: str) -> str:
@@ -66,10 +99,23 @@ def clean_json_line(line: str) -> str:
     return re.sub(r'[\x00-\x1f]', replace_char, line)
 
 
+def connect_progress_db(progress_db: Path):
+    """连接进度数据库（WAL 模式：多机器/多进程读写不互相阻塞）"""
+    conn = sqlite3.connect(progress_db)
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA cache_size=-65536;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA mmap_size=268435456;"
+    )
+    return conn
+
+
 def init_progress_db(progress_db: Path):
     """初始化进度数据库"""
     progress_db.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(progress_db)
+    conn = connect_progress_db(progress_db)
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS progress (
@@ -84,17 +130,17 @@ def init_progress_db(progress_db: Path):
 
 def get_completed_files(progress_db: Path) -> Set[str]:
     """获取已完成的文件列表"""
-    conn = sqlite3.connect(progress_db)
+    conn = connect_progress_db(progress_db)
     cursor = conn.cursor()
     cursor.execute('SELECT filename FROM progress WHERE is_done = 1')
-    completed = {row[0] for row in cursor.fetchall()}
+    completed = {row[0] for row in cursor}  # 直接迭代游标，不先 fetchall 出完整列表
     conn.close()
     return completed
 
 
 def mark_file_done(progress_db: Path, filename: str):
     """标记文件为已完成"""
-    conn = sqlite3.connect(progress_db)
+    conn = connect_progress_db(progress_db)
     cursor = conn.cursor()
     cursor.execute('''
         INSERT OR REPLACE INTO progress (filename, is_done, updated_at)
@@ -114,7 +160,9 @@ def connect_pg_db(db_config: Dict[str, str], log_file: Optional[Path] = None):
                 database=db_config['database'],
                 user=db_config['user'],
                 password=db_config['password'],
-                connect_timeout=CONNECTION_TIMEOUT
+                connect_timeout=CONNECTION_TIMEOUT,
+                # 会话级关闭 JIT：按批 corpusid 查询反复执行，JIT 编译耗时远超查询本身（随连接参数下发，重连后依然生效）
+                options='-c jit=off'
             )
             return conn
         except (OperationalError, InterfaceError) as e:
@@ -148,8 +196,20 @@ def is_db_fields_empty(record: Dict[str, Any]) -> bool:
     return True
 
 
+# 按类型分派的空值判断（JSON 结构在同一数据集内稳定，一次 dict 查找代替 isinstance 链）
+_EMPTY_CHECKS = {
+    list: lambda v: not v,
+    dict: lambda v: not (isinstance(v.get("data"), list) and v["data"]),
+    str: lambda v: not v.strip(),
+    type(None): lambda v: True,
+}
+# 未知类型：源值视为非空，目标值视为空（与原 isinstance 分支语义一致）
+_SOURCE_DEFAULT_CHECK = lambda v: False
+_TARGET_DEFAULT_CHECK = lambda v: True
+
+
 def update_record_fields(target_record: Dict[str, Any], source_record: Dict[str, Any], 
-                        fields: list, skip_if_target_not_empty: bool = False) -> int:
+                        fields: tuple, skip_if_target_not_empty: bool = False) -> int:
     """
     更新记录字段
     
@@ -167,35 +227,13 @@ def update_record_fields(target_record: Dict[str, Any], source_record: Dict[str,
         source_value = source_record.get(field)
         
         # 检查源值是否为空
-        is_empty = False
-        if source_value is None:
-            is_empty = True
-        elif isinstance(source_value, list):
-            is_empty = len(source_value) == 0
-        elif isinstance(source_value, dict):
-            data = source_value.get("data", [])
-            is_empty = not (isinstance(data, list) and len(data) > 0)
-        elif isinstance(source_value, str):
-            is_empty = not source_value.strip()
-        
-        if is_empty:
+        if _EMPTY_CHECKS.get(type(source_value), _SOURCE_DEFAULT_CHECK)(source_value):
             continue
         
         # 如果需要检查目标字段是否为空
         if skip_if_target_not_empty:
             target_value = target_record.get(field)
-            target_not_empty = False
-            
-            if target_value is not None:
-                if isinstance(target_value, list):
-                    target_not_empty = len(target_value) > 0
-                elif isinstance(target_value, dict):
-                    data = target_value.get("data", [])
-                    target_not_empty = isinstance(data, list) and len(data) > 0
-                elif isinstance(target_value, str):
-                    target_not_empty = bool(target_value.strip())
-            
-            if target_not_empty:
+            if not _EMPTY_CHECKS.get(type(target_value), _TARGET_DEFAULT_CHECK)(target_value):
                 continue
         
         # 更新字段
@@ -225,22 +263,22 @@ def load_db_data(db_conn, corpusid_list: list, db_config: Dict[str, str], log_fi
                 db_conn = connect_pg_db(db_config, log_file)
             
             cursor = db_conn.cursor()
-            placeholders = ','.join(['%s'] * len(corpusid_list))
             
+            # 整批 corpusid 作为一个数组参数绑定（= ANY），语句文本不随批大小增长
             if IGNORE_IS_DONE_FILTER:
-                query = f"""
+                query = """
                     SELECT corpusid, content
                     FROM temp_import
-                    WHERE corpusid IN ({placeholders})
+                    WHERE corpusid = ANY(%s::bigint[])
                 """
-                params = corpusid_list
+                params = (corpusid_list,)
             else:
-                query = f"""
+                query = """
                     SELECT corpusid, content
                     FROM temp_import
-                    WHERE is_done = %s AND corpusid IN ({placeholders})
+                    WHERE is_done = %s AND corpusid = ANY(%s::bigint[])
                 """
-                params = [IS_DONE_FILTER_VALUE, *corpusid_list]
+                params = (IS_DONE_FILTER_VALUE, corpusid_list)
             
             cursor.execute(query, params)
             
@@ -315,24 +353,19 @@ def process_file_pair(source_file: Path, target_file: Path,
     part2_data = {}
     db_data = {}
     
-    # 阶段1: 创建临时文件 (使用字符串路径)
+    # 阶段1: 创建临时文件 (固定命名 xxx.jsonl.tmp，直接 os.open 打开，避免 mkstemp 的随机命名+关闭+重开)
     t1 = time.time()
-    temp_fd, temp_path_str = tempfile.mkstemp(
-        suffix='.jsonl',
-        dir=str(target_file.parent),
-        prefix='.tmp_'
-    )
-    os.close(temp_fd)
-    temp_path = Path(temp_path_str)
+    temp_path_str = str(target_file) + '.tmp'
+    temp_fd = os.open(temp_path_str, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
     timings["init_temp"] = time.time() - t1
     
     try:
         BUFFER_SIZE = 4 * 1024 * 1024  # 4MB缓冲区 (从1MB增加)
         
         # 使用字符串路径避免 Windows 路径问题
-        with open(str(source_file), 'r', encoding='utf-8', buffering=BUFFER_SIZE) as f_source, \
-             open(str(target_file), 'r', encoding='utf-8', buffering=BUFFER_SIZE) as f_target, \
-             open(str(temp_path), 'w', encoding='utf-8', buffering=BUFFER_SIZE) as f_temp:
+        with os.fdopen(temp_fd, 'w', encoding='utf-8', buffering=BUFFER_SIZE) as f_temp, \
+             open(str(source_file), 'r', encoding='utf-8', buffering=BUFFER_SIZE) as f_source, \
+             open(str(target_file), 'r', encoding='utf-8', buffering=BUFFER_SIZE) as f_target:
             
                 # 阶段2: 预加载part2文件数据到内存
                 t2 = time.time()
@@ -363,10 +396,12 @@ def process_file_pair(source_file: Path, target_file: Path,
                                 log(log_file, f"跳过: part2文件第{stats['source_lines']}行解析失败 - {str(e)}")
                                 continue
                     
-                    if not is_citation_fields_empty(record):
+                    # 只保留引用字段（part2 记录其余字段不参与合并，缩小常驻内存）
+                    projected = {f: record[f] for f in CITATION_FIELDS if f in record}
+                    if not is_citation_fields_empty(projected):
                         corpusid = record.get("corpusid")
                         if corpusid is not None:
-                            part2_data[corpusid] = record
+                            part2_data[corpusid] = projected
                     else:
                         stats["skipped_empty"] += 1
                 timings["load_part2"] = time.time() - t2
@@ -397,10 +432,12 @@ def process_file_pair(source_file: Path, target_file: Path,
                     
                     stats["target_lines"] += 1
                     
-                    # 清理控制字符和处理编码问题
+                    # 清理控制字符和处理编码问题（line_repaired=True 表示原始行不能直接写回）
+                    line_repaired = False
                     try:
                         target_record = json_loads(target_line)
                     except (ValueError, Exception) as e:
+                        line_repaired = True
                         # 尝试处理 UTF-8 编码问题
                         try:
                             # 先尝试修复编码（替换无效字符）
@@ -455,8 +492,11 @@ def process_file_pair(source_file: Path, target_file: Path,
                     if record_updated:
                         stats["updated_total"] += 1
                     
-                    # 批量写入
-                    write_buffer.append(json_dumps(target_record) + '\n')
+                    # 批量写入（未更新且无需修复的记录直接写回原始行，省去一次 JSON 序列化）
+                    if record_updated or line_repaired:
+                        write_buffer.append(json_dumps(target_record) + '\n')
+                    else:
+                        write_buffer.append(target_line + '\n')
                     if len(write_buffer) >= WRITE_BATCH:
                         tw = time.time()
                         f_temp.writelines(write_buffer)
@@ -475,7 +515,6 @@ def process_file_pair(source_file: Path, target_file: Path,
         # 阶段5: 替换文件 (优化：直接替换避免删除)
         t5 = time.time()
         target_file_str = str(target_file)
-        temp_path_str = str(temp_path)
         
         # Windows上直接替换（os.replace比删除再重命名更快）
         os.replace(temp_path_str, target_file_str)
@@ -483,8 +522,8 @@ def process_file_pair(source_file: Path, target_file: Path,
         
     except Exception as e:
         try:
-            if os.path.exists(str(temp_path)):
-                os.remove(str(temp_path))
+            if os.path.exists(temp_path_str):
+                os.unlink(temp_path_str)
         except:
             pass
         raise e
@@ -524,6 +563,7 @@ def main():
     PROGRESS_DB = Path(__file__).parent.parent / "logs" / "merge_progress.db"
     LOG_FILE = Path(__file__).parent.parent / "logs" / f"merge_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
     LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+    setup_logger(LOG_FILE)
     
     start_time = time.time()
     
@@ -592,23 +632,18 @@ def main():
         # machine3 处理所有文件
         if args.machine in ['machine0', 'machine2']:
             # 获取目标目录所有文件名（不含后缀）
-            target_files_set = set()
-            for target_file in target_path.glob("*.jsonl"):
-                if not target_file.name.endswith("_part2.jsonl"):
-                    target_files_set.add(target_file.stem)
+            target_files_set = {
+                f.stem for f in target_path.glob("*.jsonl")
+                if not f.name.endswith("_part2.jsonl")
+            }
             
             log(LOG_FILE, f"目标目录文件数: {len(target_files_set)}")
             
-            # 过滤源文件：只保留目标目录中存在对应文件的
-            filtered_source_files = []
-            for source_file in source_files:
-                source_name = source_file.stem  # 例如: "4f694c82_part2"
-                if source_name.endswith("_part2"):
-                    base_name = source_name[:-6]  # 去掉 "_part2"
-                    if base_name in target_files_set:
-                        filtered_source_files.append(source_file)
-            
-            source_files = filtered_source_files
+            # 过滤源文件：只保留目标目录中存在对应文件的（"4f694c82_part2" -> "4f694c82"）
+            source_files = [
+                f for f in source_files
+                if f.stem.endswith("_part2") and f.stem[:-6] in target_files_set
+            ]
             log(LOG_FILE, f"匹配的源文件数: {len(source_files)}")
             
             if not source_files:
@@ -736,4 +771,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        shutdown_logger()
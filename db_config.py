@@ -3,6 +3,7 @@
 """
 Database Configuration V2
 """
+from functools import lru_cache
 
 # =============================================================================
 # Database Connection Config
@@ -23,15 +24,16 @@ MACHINE_DB_MAP = {
     'machine3': {'host': 'localhost', 'database': 's2orc_d3', 'port': 5433},
 }
 
+@lru_cache(maxsize=None)
 def get_db_config(machine_id: str) -> dict:
     """
-    获取数据库配置
+    获取数据库配置（按 machine_id 缓存）
     
     Args:
         machine_id: 机器ID ('machine0', 'machine1', 'machine2', 'machine3')
     
     Returns:
-        数据库配置字典
+        数据库配置字典（多次调用返回同一对象，调用方不要修改；需要改动请先 copy）
     """
     if machine_id not in MACHINE_DB_MAP:
         raise ValueError(f"Invalid machine_id: {machine_id}. Valid: {list(MACHINE_DB_MAP.keys())}")
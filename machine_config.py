@@ -2,30 +2,37 @@
 Machine Configuration - Define folders/tables for each machine
 """
 
-MACHINE_CONFIGS = {
+from types import MappingProxyType
+
+_MACHINE_CONFIGS = {
     'machine1': {
-        'folders': ['embeddings-specter_v1', 's2orc'],
-        'tables': ['embeddings_specter_v1', 's2orc'],
+        'folders': ('embeddings-specter_v1', 's2orc'),
+        'tables': ('embeddings_specter_v1', 's2orc'),
         'description': 'Machine 1: Process embeddings-specter_v1 and s2orc'
     },
     'machine2': {
-        'folders': ['embeddings-specter_v2', 's2orc_v2'],
-        'tables': ['embeddings_specter_v2', 's2orc_v2'],
+        'folders': ('embeddings-specter_v2', 's2orc_v2'),
+        'tables': ('embeddings_specter_v2', 's2orc_v2'),
         'description': 'Machine 2: Process embeddings-specter_v2 and s2orc_v2'
     },
     'machine3': {
-        'folders': ['abstracts', 'authors', 'papers', 'publication-venues', 'tldrs', 'citations'],
-        'tables': ['abstracts', 'authors', 'papers', 'publication_venues', 'tldrs', 'citations'],
+        'folders': ('abstracts', 'authors', 'papers', 'publication-venues', 'tldrs', 'citations'),
+        'tables': ('abstracts', 'authors', 'papers', 'publication_venues', 'tldrs', 'citations'),
         'description': 'Machine 3: Process abstracts, authors, papers, publication_venues, tldrs, citations (citations last due to slow processing)'
     },
     'machine0': {
-        'folders': ['paper-ids'],
-        'tables': ['paper_ids'],
+        'folders': ('paper-ids',),
+        'tables': ('paper_ids',),
         'description': 'Machine 0: Process paper-ids'
     }
 }
 
-def get_machine_config(machine_id: str) -> dict:
+# Read-only views: callers share these objects, so nothing can mutate the config in place
+MACHINE_CONFIGS = MappingProxyType({
+    machine_id: MappingProxyType(config) for machine_id, config in _MACHINE_CONFIGS.items()
+})
+
+def get_machine_config(machine_id: str) -> MappingProxyType:
     """
     Get machine configuration
     
@@ -33,9 +40,9 @@ def get_machine_config(machine_id: str) -> dict:
         machine_id: Machine ID ('machine1', 'machine2', 'machine3', 'machine0')
     
     Returns:
-        Machine configuration dict
+        Machine configuration (read-only mapping, tuple-valued folders/tables)
     """
-    if machine_id not in MACHINE_CONFIGS:
-        raise ValueError(f"Invalid machine ID: {machine_id}. Valid values: {list(MACHINE_CONFIGS.keys())}")
-    
-    return MACHINE_CONFIGS[machine_id]
+    try:
+        return MACHINE_CONFIGS[machine_id]
+    except KeyError:
+        raise ValueError(f"Invalid machine ID: {machine_id}. Valid values: {list(MACHINE_CONFIGS)}") from None
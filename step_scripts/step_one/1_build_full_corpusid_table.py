@@ -10,11 +10,11 @@ Step One - 构建完整的 corpusid 表
 """
 
 import sys
-import gzip
 import time
+import struct
 import tempfile
 from pathlib import Path
-from io import StringIO
+from io import StringIO, BytesIO
 from datetime import datetime
 
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
@@ -26,6 +26,7 @@ from tqdm import tqdm
 
 from step_scripts.step_one.machine_db_config import get_db_config
 from step_scripts.step_one.init_process_table import ProcessRecorder, DatasetType
+from step_scripts.step_one.binary_copy import open_gz, PGCOPY_HEADER, PGCOPY_TRAILER
 
 # =============================================================================
 # 配置
@@ -35,6 +36,17 @@ TABLE_NAME = 'full_corpusid'
 DATA_FOLDER = Path(r'D:\2025-09-30\paper-ids')
 BATCH_SIZE = 500000  # 每批次处理的行数（针对2亿+数据优化）
 
+# COPY 使用 BINARY 格式（免去服务端文本解析）；调试时可改为 False 走 TEXT 格式
+COPY_BINARY = True
+
+# 二进制 COPY 行：字段数 + (长度, corpusid)；帧头/结束标记取自 binary_copy
+PGCOPY_ROW = struct.Struct('>hiq')
+COPY_SQL = f"COPY {TABLE_NAME} (corpusid) FROM STDIN WITH (FORMAT BINARY)"
+
+# corpusid 列为 BIGINT
+BIGINT_MIN = -2 ** 63
+BIGINT_MAX = 2 ** 63 - 1
+
 # =============================================================================
 # 数据库操作
 # =============================================================================
@@ -82,28 +94,33 @@ def process_gz_file(gz_path, cursor, conn):
     batch_buffer = []
     
     try:
-        with gzip.open(gz_path, 'rb') as f:
+        with open_gz(gz_path) as f:
             for line in f:
                 if not line.strip():
                     continue
                 
+                # 只有解析放在逐行 try 内：corpusid 在这里转成 BIGINT 范围内的 int，
+                # 坏值在此跳过，不会进入批次导致整批 COPY 失败
                 try:
-                    data = orjson.loads(line)
-                    corpusid = data.get('corpusid')
-                    
-                    if corpusid is not None:
-                        batch_buffer.append(str(corpusid))
-                        
-                        # 达到批次大小时执行插入
-                        if len(batch_buffer) >= BATCH_SIZE:
-                            insert_batch(cursor, batch_buffer)
-                            total_inserted += len(batch_buffer)
-                            batch_buffer = []
-                            conn.commit()
+                    corpusid = orjson.loads(line).get('corpusid')
+                    if corpusid is None:
+                        continue
+                    corpusid = int(corpusid)
+                    if not BIGINT_MIN <= corpusid <= BIGINT_MAX:
+                        raise ValueError(f"corpusid 超出 BIGINT 范围: {corpusid}")
                 
                 except Exception as e:
                     print(f"⚠️  解析行失败: {e}")
                     continue
+                
+                batch_buffer.append(corpusid)
+                
+                # 达到批次大小时执行插入（插入失败向外抛出，由外层回滚）
+                if len(batch_buffer) >= BATCH_SIZE:
+                    insert_batch(cursor, batch_buffer)
+                    total_inserted += len(batch_buffer)
+                    batch_buffer = []
+                    conn.commit()
         
         # 插入剩余数据
         if batch_buffer:
@@ -120,6 +137,22 @@ def process_gz_file(gz_path, cursor, conn):
 
 def insert_batch(cursor, corpusid_list):
     """使用 COPY 批量插入数据"""
+    if not COPY_BINARY:
+        insert_batch_text(cursor, corpusid_list)
+        return
+    
+    buffer = BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    pack_row = PGCOPY_ROW.pack
+    for corpusid in corpusid_list:
+        buffer.write(pack_row(1, 8, corpusid))
+    buffer.write(PGCOPY_TRAILER)
+    buffer.seek(0)
+    
+    cursor.copy_expert(COPY_SQL, buffer)
+
+def insert_batch_text(cursor, corpusid_list):
+    """使用 TEXT 格式 COPY 批量插入数据（调试用）"""
     buffer = StringIO()
     for corpusid in corpusid_list:
         buffer.write(f"{corpusid}\n")
@@ -142,6 +175,10 @@ def build_index_and_sort(cursor, conn):
     start_time = time.time()
     temp_table = f"{TABLE_NAME}_new"
     
+    # 去重（DISTINCT）和主键构建的内存
+    cursor.execute("SET work_mem = '2GB'")
+    cursor.execute("SET maintenance_work_mem = '8GB'")
+    
     cursor.execute(f"""
         CREATE TABLE {temp_table} (
             corpusid BIGINT PRIMARY KEY
@@ -233,6 +270,10 @@ def main():
             return
         conn.commit()
         
+        # 优化数据库配置（批量导入：异步提交，不等待每次提交的 WAL 刷盘）
+        cursor.execute("SET synchronous_commit = OFF")
+        cursor.execute("SET work_mem = '512MB'")
+        
         # 处理待处理的 gz 文件
         print("\n" + "="*70)
         print("开始处理 gz 文件")
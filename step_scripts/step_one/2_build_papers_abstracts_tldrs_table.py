@@ -11,21 +11,22 @@ Step One - 构建 papers/abstracts/tldrs 分区表
 """
 
 import sys
-import gzip
 import time
 from pathlib import Path
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io import StringIO
 from datetime import datetime
 
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-import orjson
 import psycopg2
 from psycopg2 import sql
 from tqdm import tqdm
 
 from step_scripts.step_one.machine_db_config import get_db_config
 from step_scripts.step_one.init_process_table import ProcessRecorder, DatasetType
+from step_scripts.step_one.binary_copy import BinaryCopyStream, COPY_READ_SIZE, copy_sql, extract_corpusid, open_gz
 
 # =============================================================================
 # 配置
@@ -68,7 +69,16 @@ PARTITION_CONFIG = {
     'max_corpusid': 300000000,  # 3亿（覆盖所有可能的corpusid）
 }
 
-BATCH_SIZE = 500000  # 每批次处理的行数
+BATCH_SIZE = 1000000  # 每批次（每次 COPY + 提交）的行数；COPY 流式序列化，批次大小不再决定内存占用
+
+# 并行导入进程数：每个进程独立连接数据库，解析并 COPY 不同的 gz 文件（1 表示串行）
+NUM_WORKERS = 8
+
+# 目标数据库（主进程与各 worker 进程连接同一台机器）
+MACHINE_ID = 'machine2'
+
+# COPY 使用 BINARY 格式（免去逐行转义和服务端文本解析）；调试时可改为 False 走 TEXT 格式
+COPY_BINARY = True
 
 # =============================================================================
 # 分区表管理
@@ -114,6 +124,7 @@ def create_partitioned_table(cursor, table_name, partition_size):
     max_id = PARTITION_CONFIG['max_corpusid']
     
     partitions = []
+    partition_ddl = []
     current_min = min_id
     partition_num = 0
     
@@ -123,10 +134,10 @@ def create_partitioned_table(cursor, table_name, partition_size):
         current_max = min(current_min + partition_size, max_id)
         partition_name = f"{table_name}_p{partition_num}"
         
-        cursor.execute(f"""
-            CREATE TABLE {partition_name} PARTITION OF {table_name}
-            FOR VALUES FROM ({current_min}) TO ({current_max});
-        """)
+        partition_ddl.append(
+            f"CREATE TABLE {partition_name} PARTITION OF {table_name} "
+            f"FOR VALUES FROM ({current_min}) TO ({current_max});"
+        )
         
         partitions.append({
             'name': partition_name,
@@ -139,10 +150,10 @@ def create_partitioned_table(cursor, table_name, partition_size):
     
     # 创建默认分区（捕获超出范围的数据）
     default_partition = f"{table_name}_default"
-    cursor.execute(f"""
-        CREATE TABLE {default_partition} PARTITION OF {table_name}
-        DEFAULT;
-    """)
+    partition_ddl.append(f"CREATE TABLE {default_partition} PARTITION OF {table_name} DEFAULT;")
+    
+    # 所有分区 DDL 合并为一次提交，避免逐条往返
+    cursor.execute("\n".join(partition_ddl))
     
     print(f"✅ 创建了 {len(partitions)} 个分区 + 1 个默认分区")
     print(f"   分区范围: {min_id:,} - {max_id:,}")
@@ -181,6 +192,10 @@ def build_partition_indexes(cursor, conn, table_name):
     
     start_time = time.time()
     
+    # 优化索引构建参数
+    cursor.execute("SET maintenance_work_mem = '8GB'")
+    cursor.execute("SET max_parallel_maintenance_workers = 8")
+    
     with tqdm(total=len(partitions), desc="建立索引", unit="分区") as pbar:
         for partition in partitions:
             try:
@@ -223,39 +238,15 @@ def process_gz_file(gz_path, cursor, conn, table_name):
         插入的记录数
     """
     total_inserted = 0
-    batch_buffer = []
     
     try:
-        with gzip.open(gz_path, 'rb') as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                
-                try:
-                    data = orjson.loads(line)
-                    corpusid = data.get('corpusid')
-                    
-                    if corpusid is not None:
-                        # 将完整的 JSON 数据转换为字符串
-                        json_str = orjson.dumps(data).decode('utf-8')
-                        batch_buffer.append((corpusid, json_str))
-                        
-                        # 达到批次大小时执行插入
-                        if len(batch_buffer) >= BATCH_SIZE:
-                            insert_batch(cursor, table_name, batch_buffer)
-                            total_inserted += len(batch_buffer)
-                            batch_buffer = []
-                            conn.commit()
-                
-                except Exception as e:
-                    # 跳过解析失败的行
-                    continue
-        
-        # 插入剩余数据
-        if batch_buffer:
-            insert_batch(cursor, table_name, batch_buffer)
-            total_inserted += len(batch_buffer)
-            conn.commit()
+        with open_gz(gz_path) as f:
+            records = iter_gz_records(f)
+            # 每批取 BATCH_SIZE 行交给 COPY，边解析边发送
+            for first in records:
+                batch = chain((first,), islice(records, BATCH_SIZE - 1))
+                total_inserted += insert_batch(cursor, table_name, batch)
+                conn.commit()
     
     except Exception as e:
         print(f"❌ 处理文件失败 {gz_path.name}: {e}")
@@ -264,16 +255,116 @@ def process_gz_file(gz_path, cursor, conn, table_name):
     
     return total_inserted
 
-def insert_batch(cursor, table_name, data_list):
-    """使用 COPY 批量插入数据"""
+def iter_gz_records(f):
+    """逐行读取 gz 文件，产出 (corpusid, 整行JSON字节)，跳过空行和解析失败的行"""
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        
+        try:
+            corpusid = extract_corpusid(line)
+            
+            if corpusid is not None:
+                # 整行 JSON 字节原样写入 data，不经过 loads/dumps 往返
+                yield corpusid, line
+        
+        except Exception as e:
+            # 跳过解析失败的行
+            continue
+
+# worker 进程内的数据库连接（由 init_import_worker 初始化，进程内复用）
+_worker_conn = None
+_worker_cursor = None
+
+def apply_import_session_settings(conn, cursor):
+    """在执行 COPY 的连接上设置导入用会话参数"""
+    # 批量导入：异步提交，不等待每次提交的 WAL 刷盘
+    cursor.execute("SET synchronous_commit = OFF")
+    cursor.execute("SET work_mem = '512MB'")
+    # 连接在整个导入期间复用：大批次 COPY 不受服务端默认超时限制
+    cursor.execute("SET statement_timeout = 0")
+    cursor.execute("SET idle_in_transaction_session_timeout = 0")
+    # 立即提交：会话参数不留在未提交事务里，首个文件 COPY 失败回滚时也不会丢失
+    conn.commit()
+
+def init_import_worker(machine):
+    """worker 进程初始化：建立本进程专用的数据库连接"""
+    global _worker_conn, _worker_cursor
+    _worker_conn = psycopg2.connect(**get_db_config(machine))
+    _worker_cursor = _worker_conn.cursor()
+    apply_import_session_settings(_worker_conn, _worker_cursor)
+
+def import_gz_file_worker(gz_path, table_name):
+    """worker 进程：导入单个 gz 文件，返回 (文件名, 插入记录数)"""
+    return gz_path.name, process_gz_file(gz_path, _worker_cursor, _worker_conn, table_name)
+
+def iter_imported_files(pending_files, cursor, conn, table_name, machine):
+    """
+    导入待处理的 gz 文件，每完成一个产出 (文件名, 插入记录数)
+    
+    NUM_WORKERS > 1 时用多进程并行导入（完成顺序不保证与文件顺序一致）。
+    某个文件失败时取消尚未开始的文件，但仍等待已在运行的文件完成并逐个产出
+    （它们已各自提交，必须交给调用方记录，否则续传时会被重复 COPY），全部收尾后再抛出首个异常
+    """
+    if NUM_WORKERS <= 1:
+        # 串行时由主连接执行 COPY
+        apply_import_session_settings(conn, cursor)
+        for gz_file in pending_files:
+            yield gz_file.name, process_gz_file(gz_file, cursor, conn, table_name)
+        return
+    
+    executor = ProcessPoolExecutor(max_workers=NUM_WORKERS,
+                                   initializer=init_import_worker, initargs=(machine,))
+    try:
+        futures = [executor.submit(import_gz_file_worker, gz_file, table_name) for gz_file in pending_files]
+        first_error = None
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                if first_error is None:
+                    first_error = e
+                    for pending in futures:
+                        pending.cancel()
+                continue
+            yield result
+        if first_error is not None:
+            raise first_error
+    finally:
+        # 调用方提前退出时同样取消尚未开始的文件，并等待运行中的文件结束
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def insert_batch(cursor, table_name, rows):
+    """
+    使用 COPY 批量插入数据
+    
+    Args:
+        rows: 产出 (corpusid, JSON 字节) 的可迭代对象
+    
+    Returns:
+        插入的记录数
+    """
+    if not COPY_BINARY:
+        return insert_batch_text(cursor, table_name, list(rows))
+    
+    stream = BinaryCopyStream(rows)
+    cursor.copy_expert(copy_sql(table_name), stream, size=COPY_READ_SIZE)
+    return stream.row_count
+
+def insert_batch_text(cursor, table_name, data_list):
+    """使用 TEXT 格式 COPY 批量插入数据（调试用）"""
     buffer = StringIO()
     for corpusid, json_data in data_list:
         # 转义特殊字符
-        json_escaped = json_data.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+        json_escaped = json_data.decode('utf-8').replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
         buffer.write(f"{corpusid}\t{json_escaped}\n")
     buffer.seek(0)
     
     cursor.copy_from(buffer, table_name, columns=('corpusid', 'data'))
+    return len(data_list)
 
 # =============================================================================
 # 主流程
@@ -306,7 +397,7 @@ def process_dataset(dataset_name, dataset_config, conn, cursor):
         return
     
     # 初始化断点续传记录器
-    recorder = ProcessRecorder(machine='machine2')
+    recorder = ProcessRecorder(machine=MACHINE_ID)
     
     # 获取所有 gz 文件
     gz_files = sorted(folder.glob("*.gz"))
@@ -340,21 +431,19 @@ def process_dataset(dataset_name, dataset_config, conn, cursor):
     conn.commit()
     
     # 处理待处理的 gz 文件
-    print(f"\n开始处理 gz 文件...")
+    print(f"\n开始处理 gz 文件（{NUM_WORKERS} 个进程）...")
     
     total_records = 0
     start_time = time.time()
     
     with tqdm(total=len(pending_files), desc="处理进度", unit="file",
               bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]') as pbar:
-        for idx, gz_file in enumerate(pending_files, 1):
-            file_start = time.time()
-            records = process_gz_file(gz_file, cursor, conn, table_name)
-            file_elapsed = time.time() - file_start
+        imported = iter_imported_files(pending_files, cursor, conn, table_name, MACHINE_ID)
+        for idx, (gz_name, records) in enumerate(imported, 1):
             total_records += records
             
             # 记录文件已处理（只有当前文件完全处理完才记录）
-            recorder.add_record(gz_file.name, dataset_type)
+            recorder.add_record(gz_name, dataset_type)
             
             # 计算预估剩余时间
             elapsed = time.time() - start_time
@@ -366,7 +455,7 @@ def process_dataset(dataset_name, dataset_config, conn, cursor):
             pbar.set_postfix({
                 '当前': f'{records:,}条',
                 '总计': f'{total_records:,}条',
-                '速度': f'{records/file_elapsed:.0f}条/秒',
+                '速度': f'{total_records/elapsed:.0f}条/秒',
                 '预计剩余': eta_str
             })
             pbar.update(1)
@@ -386,7 +475,9 @@ def main():
     print("="*70)
     print("Step One - 构建 papers/abstracts/tldrs 分区表")
     print(f"批次大小: {BATCH_SIZE:,}")
+    print(f"并行进程: {NUM_WORKERS}")
     print(f"数据类型: corpusid (BIGINT) + data (TEXT)")
+    print(f"COPY 格式: {'BINARY' if COPY_BINARY else 'TEXT'}")
     print("="*70)
     
     # 选择要处理的数据集
@@ -413,7 +504,7 @@ def main():
     
     # 连接数据库
     try:
-        config = get_db_config('machine2')
+        config = get_db_config(MACHINE_ID)
         print(f"\n连接数据库: {config['database']}@{config['host']}:{config['port']}")
         conn = psycopg2.connect(**config)
         cursor = conn.cursor()
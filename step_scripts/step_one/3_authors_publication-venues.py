@@ -12,10 +12,9 @@ Step One - 构建 authors 和 publication_venues 表
 """
 
 import sys
-import gzip
 import time
 from pathlib import Path
-from io import StringIO
+from io import BytesIO
 from datetime import datetime
 
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
@@ -27,6 +26,7 @@ from tqdm import tqdm
 
 from step_scripts.step_one.machine_db_config import get_db_config
 from step_scripts.step_one.init_process_table import ProcessRecorder, DatasetType
+from step_scripts.step_one.binary_copy import open_gz
 
 # =============================================================================
 # 配置
@@ -117,6 +117,7 @@ def create_partitioned_table(cursor, dataset_config):
     max_id = PARTITION_CONFIG['max_id']
     
     partitions = []
+    partition_ddl = []
     current_min = min_id
     partition_num = 0
     
@@ -126,10 +127,10 @@ def create_partitioned_table(cursor, dataset_config):
         current_max = min(current_min + partition_size, max_id)
         partition_name = f"{table_name}_p{partition_num}"
         
-        cursor.execute(f"""
-            CREATE TABLE {partition_name} PARTITION OF {table_name}
-            FOR VALUES FROM ({current_min}) TO ({current_max});
-        """)
+        partition_ddl.append(
+            f"CREATE TABLE {partition_name} PARTITION OF {table_name} "
+            f"FOR VALUES FROM ({current_min}) TO ({current_max});"
+        )
         
         partitions.append({
             'name': partition_name,
@@ -142,10 +143,10 @@ def create_partitioned_table(cursor, dataset_config):
     
     # 创建默认分区
     default_partition = f"{table_name}_default"
-    cursor.execute(f"""
-        CREATE TABLE {default_partition} PARTITION OF {table_name}
-        DEFAULT;
-    """)
+    partition_ddl.append(f"CREATE TABLE {default_partition} PARTITION OF {table_name} DEFAULT;")
+    
+    # 所有分区 DDL 合并为一次提交，避免逐条往返
+    cursor.execute("\n".join(partition_ddl))
     
     print(f"✅ 创建了 {len(partitions)} 个分区 + 1 个默认分区")
     print(f"   分区范围: {min_id:,} - {max_id:,}")
@@ -231,6 +232,10 @@ def build_partition_indexes(cursor, conn, dataset_config):
     
     start_time = time.time()
     
+    # 优化索引构建参数
+    cursor.execute("SET maintenance_work_mem = '8GB'")
+    cursor.execute("SET max_parallel_maintenance_workers = 8")
+    
     with tqdm(total=len(partitions), desc="建立索引", unit="分区") as pbar:
         for partition in partitions:
             try:
@@ -271,6 +276,10 @@ def build_normal_table_index(cursor, conn, dataset_config):
     
     start_time = time.time()
     
+    # 优化索引构建参数
+    cursor.execute("SET maintenance_work_mem = '8GB'")
+    cursor.execute("SET max_parallel_maintenance_workers = 8")
+    
     # 建立主键索引
     cursor.execute(f"""
         ALTER TABLE {table_name}
@@ -316,7 +325,7 @@ def process_gz_file(gz_path, cursor, conn, dataset_config):
     batch_buffer = []
     
     try:
-        with gzip.open(gz_path, 'rb') as f:
+        with open_gz(gz_path) as f:
             for line in f:
                 if not line.strip():
                     continue
@@ -326,8 +335,8 @@ def process_gz_file(gz_path, cursor, conn, dataset_config):
                     key_value = data.get(json_field)
                     
                     if key_value is not None:
-                        # 将完整的 JSON 数据转换为字符串
-                        json_str = orjson.dumps(data).decode('utf-8')
+                        # 将完整的 JSON 数据序列化为 UTF-8 字节
+                        json_bytes = orjson.dumps(data)
                         
                         # 根据主键类型处理
                         if primary_key_type == 'BIGINT':
@@ -340,7 +349,7 @@ def process_gz_file(gz_path, cursor, conn, dataset_config):
                             # publicationvenueid 保持字符串
                             key_value = str(key_value)
                         
-                        batch_buffer.append((key_value, json_str))
+                        batch_buffer.append((key_value, json_bytes))
                         
                         # 达到批次大小时执行插入
                         if len(batch_buffer) >= BATCH_SIZE:
@@ -368,14 +377,15 @@ def process_gz_file(gz_path, cursor, conn, dataset_config):
 
 def insert_batch(cursor, table_name, data_list):
     """使用 COPY 批量插入数据"""
-    buffer = StringIO()
+    buffer = bytearray()
     for key_value, json_data in data_list:
-        # 转义特殊字符
-        json_escaped = json_data.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
-        buffer.write(f"{key_value}\t{json_escaped}\n")
-    buffer.seek(0)
+        buffer += str(key_value).encode('utf-8')
+        buffer += b'\t'
+        # orjson 输出中换行/制表符等控制字符均已转义为 \n 形式，COPY TEXT 只需再转义反斜杠
+        buffer += json_data.replace(b'\\', b'\\\\')
+        buffer += b'\n'
     
-    cursor.copy_from(buffer, table_name)
+    cursor.copy_from(BytesIO(buffer), table_name)
 
 # =============================================================================
 # 主流程
@@ -448,6 +458,10 @@ def process_dataset(dataset_name, dataset_config, conn, cursor):
             return
     conn.commit()
     
+    # 优化数据库配置（批量导入：异步提交，不等待每次提交的 WAL 刷盘）
+    cursor.execute("SET synchronous_commit = OFF")
+    cursor.execute("SET work_mem = '512MB'")
+    
     # 处理待处理的 gz 文件
     print(f"\n开始处理 gz 文件...")
     
@@ -14,8 +14,9 @@ Step One - 构建 citations 和 references 表
 """
 
 import sys
-import gzip
 import time
+import struct
+from io import BytesIO
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
@@ -26,6 +27,7 @@ from tqdm import tqdm
 
 from step_scripts.step_one.machine_db_config import get_db_config
 from step_scripts.step_one.init_process_table import ProcessRecorder, DatasetType
+from step_scripts.step_one.binary_copy import open_gz, PGCOPY_HEADER, PGCOPY_TRAILER
 
 # =============================================================================
 # 配置
@@ -35,6 +37,14 @@ CITATION_RAW_TABLE = 'citation_raw'
 DATA_FOLDER = Path(r'D:\2025-09-30\citations')
 BATCH_SIZE = 500000  # 每批次处理的行数
 
+# 二进制 COPY 行：字段数 + (长度, citingcorpusid) + (长度, citedcorpusid)，每行一次 pack，无需格式化整数文本
+CITATION_ROW = struct.Struct('>hiqiq')
+CITATION_COPY_SQL = f"COPY {CITATION_RAW_TABLE} (citingcorpusid, citedcorpusid) FROM STDIN WITH (FORMAT BINARY)"
+
+# citingcorpusid / citedcorpusid 列为 BIGINT
+BIGINT_MIN = -2 ** 63
+BIGINT_MAX = 2 ** 63 - 1
+
 # 分区配置（citation_raw表：160GB, 30亿行）
 PARTITION_CONFIG = {
     'min_id': 0,
@@ -84,6 +94,7 @@ def create_citation_raw_table(cursor, conn):
     print(f"创建分区（每分区{partition_size:,}个ID范围）...")
     
     partitions = []
+    partition_ddl = []
     current_min = min_id
     partition_num = 0
     
@@ -91,11 +102,11 @@ def create_citation_raw_table(cursor, conn):
         current_max = min(current_min + partition_size, max_id)
         partition_name = f"{CITATION_RAW_TABLE}_p{partition_num}"
         
-        cursor.execute(f"""
-            CREATE TABLE {partition_name} PARTITION OF {CITATION_RAW_TABLE}
-            FOR VALUES FROM ({current_min}) TO ({current_max})
-            WITH (fillfactor = 100, autovacuum_enabled = false);
-        """)
+        partition_ddl.append(
+            f"CREATE TABLE {partition_name} PARTITION OF {CITATION_RAW_TABLE} "
+            f"FOR VALUES FROM ({current_min}) TO ({current_max}) "
+            f"WITH (fillfactor = 100, autovacuum_enabled = false);"
+        )
         
         partitions.append(partition_name)
         current_min = current_max
@@ -103,10 +114,13 @@ def create_citation_raw_table(cursor, conn):
     
     # 创建默认分区
     default_partition = f"{CITATION_RAW_TABLE}_default"
-    cursor.execute(f"""
-        CREATE TABLE {default_partition} PARTITION OF {CITATION_RAW_TABLE}
-        DEFAULT WITH (fillfactor = 100, autovacuum_enabled = false);
-    """)
+    partition_ddl.append(
+        f"CREATE TABLE {default_partition} PARTITION OF {CITATION_RAW_TABLE} "
+        f"DEFAULT WITH (fillfactor = 100, autovacuum_enabled = false);"
+    )
+    
+    # 所有分区 DDL 合并为一次提交，避免逐条往返
+    cursor.execute("\n".join(partition_ddl))
     
     conn.commit()
     print(f"✅ 表创建成功：{len(partitions)}个分区 + 1个默认分区")
@@ -156,24 +170,32 @@ def import_citations_gz(cursor, conn):
             file_start = time.time()
             batch_buffer = []
             
-            with gzip.open(gz_file, 'rt', encoding='utf-8') as f:
+            # 以字节方式读取，orjson 直接解析 bytes，省去逐行 UTF-8 解码
+            with open_gz(gz_file) as f:
                 for line in f:
+                    # 只有解析放在逐行 try 内：id 在这里转成 BIGINT 范围内的 int，坏行在此跳过，
+                    # 不会进入批次导致 pack / COPY 失败
                     try:
-                        data = orjson.loads(line.strip())
+                        data = orjson.loads(line)
                         citing = data.get('citingcorpusid')
                         cited = data.get('citedcorpusid')
-                        
-                        if citing is not None and cited is not None:
-                            batch_buffer.append((citing, cited))
-                            
-                            # 批量插入
-                            if len(batch_buffer) >= BATCH_SIZE:
-                                insert_batch(cursor, batch_buffer)
-                                total_records += len(batch_buffer)
-                                batch_buffer = []
-                                conn.commit()
+                        if citing is None or cited is None:
+                            continue
+                        citing = int(citing)
+                        cited = int(cited)
+                        if not (BIGINT_MIN <= citing <= BIGINT_MAX and BIGINT_MIN <= cited <= BIGINT_MAX):
+                            continue
                     except:
                         continue
+                    
+                    batch_buffer.append((citing, cited))
+                    
+                    # 批量插入（插入失败直接抛出，不会被逐行 except 吞掉）
+                    if len(batch_buffer) >= BATCH_SIZE:
+                        insert_batch(cursor, batch_buffer)
+                        total_records += len(batch_buffer)
+                        batch_buffer = []
+                        conn.commit()
             
             # 插入剩余数据
             if batch_buffer:
@@ -194,13 +216,14 @@ def import_citations_gz(cursor, conn):
     recorder.close()
 
 def insert_batch(cursor, data_list):
-    """批量插入数据"""
-    from io import StringIO
-    buffer = StringIO()
-    for citing, cited in data_list:
-        buffer.write(f"{citing}\t{cited}\n")
-    buffer.seek(0)
-    cursor.copy_from(buffer, CITATION_RAW_TABLE, columns=('citingcorpusid', 'citedcorpusid'))
+    """批量插入数据（二进制 COPY）"""
+    pack_row = CITATION_ROW.pack
+    payload = b''.join([
+        PGCOPY_HEADER,
+        *(pack_row(2, 8, citing, 8, cited) for citing, cited in data_list),
+        PGCOPY_TRAILER,
+    ])
+    cursor.copy_expert(CITATION_COPY_SQL, BytesIO(payload))
 
 # =============================================================================
 # 阶段2：创建索引
@@ -269,11 +292,11 @@ def build_references(cursor, conn):
     print("\n【阶段3】构造 temp_references...")
     
     # 检查是否已存在
-    cursor.execute("SELECT to_regclass('temp_references')")
-    if cursor.fetchone()[0]:
-        cursor.execute("SELECT COUNT(*) FROM temp_references")
-        count = cursor.fetchone()[0]
-        print(f"⚠️  temp_references 已存在（{count:,}条）")
+    # 行数取 pg_class 估计值（建表后的 CREATE INDEX 已更新），避免为提示信息全表 COUNT(*)
+    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass('temp_references')")
+    row = cursor.fetchone()
+    if row:
+        print(f"⚠️  temp_references 已存在（约{max(row[0], 0):,}条）")
         response = input("是否重建？(yes/no): ").strip().lower()
         if response != 'yes':
             print("跳过重建")
@@ -296,15 +319,13 @@ def build_references(cursor, conn):
         FROM {CITATION_RAW_TABLE}
         GROUP BY citingcorpusid
     """)
+    count = cursor.rowcount  # CREATE TABLE AS 的命令标签即写入行数
     
     # 创建索引
     print("创建索引...")
     cursor.execute("SET maintenance_work_mem = '4GB'")
     cursor.execute("CREATE INDEX idx_temp_references_corpusid ON temp_references (corpusid)")
     
-    # 统计结果
-    cursor.execute("SELECT COUNT(*) FROM temp_references")
-    count = cursor.fetchone()[0]
     conn.commit()
     
     elapsed = time.time() - start_time
@@ -319,11 +340,11 @@ def build_citations(cursor, conn):
     print("\n【阶段4】构造 temp_citations...")
     
     # 检查是否已存在
-    cursor.execute("SELECT to_regclass('temp_citations')")
-    if cursor.fetchone()[0]:
-        cursor.execute("SELECT COUNT(*) FROM temp_citations")
-        count = cursor.fetchone()[0]
-        print(f"⚠️  temp_citations 已存在（{count:,}条）")
+    # 行数取 pg_class 估计值（建表后的 CREATE INDEX 已更新），避免为提示信息全表 COUNT(*)
+    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass('temp_citations')")
+    row = cursor.fetchone()
+    if row:
+        print(f"⚠️  temp_citations 已存在（约{max(row[0], 0):,}条）")
         response = input("是否重建？(yes/no): ").strip().lower()
         if response != 'yes':
             print("跳过重建")
@@ -346,15 +367,13 @@ def build_citations(cursor, conn):
         FROM {CITATION_RAW_TABLE}
         GROUP BY citedcorpusid
     """)
+    count = cursor.rowcount  # CREATE TABLE AS 的命令标签即写入行数
     
     # 创建索引
     print("创建索引...")
     cursor.execute("SET maintenance_work_mem = '4GB'")
     cursor.execute("CREATE INDEX idx_temp_citations_corpusid ON temp_citations (corpusid)")
     
-    # 统计结果
-    cursor.execute("SELECT COUNT(*) FROM temp_citations")
-    count = cursor.fetchone()[0]
     conn.commit()
     
     elapsed = time.time() - start_time
@@ -12,8 +12,8 @@ Step One - 构建 corpusid_mapping_title 表
 """
 
 import sys
-import gzip
 import time
+from io import BytesIO
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
@@ -23,6 +23,7 @@ import psycopg2
 from tqdm import tqdm
 
 from step_scripts.step_one.machine_db_config import get_db_config
+from step_scripts.step_one.binary_copy import open_gz
 
 # =============================================================================
 # 配置
@@ -115,11 +116,12 @@ def import_papers_gz(cursor, conn):
             file_count = 0
             
             # 读取并插入数据
-            with gzip.open(gz_file, 'rt', encoding='utf-8') as f:
+            # 以字节方式读取，orjson 直接解析 bytes，省去逐行 UTF-8 解码
+            with open_gz(gz_file) as f:
                 batch = []
                 for line in f:
                     try:
-                        data = orjson.loads(line.strip())
+                        data = orjson.loads(line)
                         corpusid = data.get('corpusid')
                         title = data.get('title', '')
                         
@@ -165,14 +167,15 @@ def import_papers_gz(cursor, conn):
 
 def insert_batch(cursor, data_list):
     """批量插入数据到临时表"""
-    from io import StringIO
-    buffer = StringIO()
+    buffer = bytearray()
     for corpusid, title in data_list:
         # 转义特殊字符
         title_escaped = str(title).replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
-        buffer.write(f"{corpusid}\t{title_escaped}\n")
-    buffer.seek(0)
-    cursor.copy_from(buffer, 'temp_papers', columns=('corpusid', 'title'))
+        buffer += str(corpusid).encode('utf-8')
+        buffer += b'\t'
+        buffer += title_escaped.encode('utf-8')
+        buffer += b'\n'
+    cursor.copy_from(BytesIO(buffer), 'temp_papers', columns=('corpusid', 'title'))
 
 # =============================================================================
 # 阶段2：创建主键索引
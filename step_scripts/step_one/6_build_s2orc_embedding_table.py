@@ -18,18 +18,19 @@ Step One - 构建 s2orc 和 embeddings 表
 """
 
 import sys
-import gzip
 import time
+from io import StringIO
+from itertools import chain, islice
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-import orjson
 import psycopg2
 from tqdm import tqdm
 
 from step_scripts.step_one.machine_db_config import get_db_config
 from step_scripts.step_one.init_process_table import ProcessRecorder, DatasetType
+from step_scripts.step_one.binary_copy import BinaryCopyStream, COPY_READ_SIZE, copy_sql, extract_corpusid, open_gz
 
 # =============================================================================
 # 数据集配置
@@ -78,7 +79,10 @@ DATASETS = {
     }
 }
 
-BATCH_SIZE = 50000  # 每批次处理的行数
+BATCH_SIZE = 200000  # 每批次（每次 COPY + 提交）的行数；COPY 流式序列化，批次大小不再决定内存占用
+
+# COPY 使用 BINARY 格式（免去逐行转义和服务端文本解析）；调试时可改为 False 走 TEXT 格式
+COPY_BINARY = True
 
 # =============================================================================
 # 阶段0：创建表
@@ -129,31 +133,33 @@ def create_table(dataset_key, cursor, conn):
     print(f"创建分区（每分区{partition_size:,}个ID范围）...")
     
     partitions = []
+    partition_ddl = []
     current_min = min_id
     partition_num = 0
     
-    with tqdm(total=dataset['partition_count'], desc="创建分区", unit="分区") as pbar:
-        while current_min < max_id:
-            current_max = min(current_min + partition_size, max_id)
-            partition_name = f"{table_name}_p{partition_num}"
-            
-            cursor.execute(f"""
-                CREATE TABLE {partition_name} PARTITION OF {table_name}
-                FOR VALUES FROM ({current_min}) TO ({current_max})
-                WITH (fillfactor = 100, autovacuum_enabled = false);
-            """)
-            
-            partitions.append(partition_name)
-            current_min = current_max
-            partition_num += 1
-            pbar.update(1)
+    while current_min < max_id:
+        current_max = min(current_min + partition_size, max_id)
+        partition_name = f"{table_name}_p{partition_num}"
+        
+        partition_ddl.append(
+            f"CREATE TABLE {partition_name} PARTITION OF {table_name} "
+            f"FOR VALUES FROM ({current_min}) TO ({current_max}) "
+            f"WITH (fillfactor = 100, autovacuum_enabled = false);"
+        )
+        
+        partitions.append(partition_name)
+        current_min = current_max
+        partition_num += 1
     
     # 创建默认分区
     default_partition = f"{table_name}_default"
-    cursor.execute(f"""
-        CREATE TABLE {default_partition} PARTITION OF {table_name}
-        DEFAULT WITH (fillfactor = 100, autovacuum_enabled = false);
-    """)
+    partition_ddl.append(
+        f"CREATE TABLE {default_partition} PARTITION OF {table_name} "
+        f"DEFAULT WITH (fillfactor = 100, autovacuum_enabled = false);"
+    )
+    
+    # 所有分区 DDL 合并为一次提交，避免逐条往返
+    cursor.execute("\n".join(partition_ddl))
     
     conn.commit()
     print(f"✅ 表创建成功：{len(partitions)}个分区 + 1个默认分区")
@@ -206,40 +212,14 @@ def import_dataset_gz(dataset_key, cursor, conn):
     
     with tqdm(total=len(pending_files), desc="导入进度", unit="file") as pbar:
         for gz_file in pending_files:
-            file_count = 0
-            batch_buffer = []
-            
-            with gzip.open(gz_file, 'rt', encoding='utf-8') as f:
-                for line in f:
-                    try:
-                        line_stripped = line.strip()
-                        if not line_stripped:
-                            continue
-                        
-                        # 解析JSON获取corpusid
-                        data = orjson.loads(line_stripped)
-                        corpusid = data.get('corpusid')
-                        
-                        # 检查 corpusid 是否存在
-                        if corpusid is not None:
-                            # 存储整行JSON数据
-                            batch_buffer.append((corpusid, line_stripped))
-                            file_count += 1
-                            
-                            # 批量插入
-                            if len(batch_buffer) >= BATCH_SIZE:
-                                insert_batch(cursor, table_name, batch_buffer)
-                                total_records += len(batch_buffer)
-                                batch_buffer = []
-                                conn.commit()
-                    except:
-                        continue
-            
-            # 插入剩余数据
-            if batch_buffer:
-                insert_batch(cursor, table_name, batch_buffer)
-                total_records += len(batch_buffer)
-                conn.commit()
+            # 以字节方式读取：整行字节原样进入二进制 COPY，无需解码/再编码
+            with open_gz(gz_file) as f:
+                records = iter_gz_records(f)
+                # 每批取 BATCH_SIZE 行交给 COPY，边解析边发送
+                for first in records:
+                    batch = chain((first,), islice(records, BATCH_SIZE - 1))
+                    total_records += insert_batch(cursor, table_name, batch)
+                    conn.commit()
             
             # 记录文件已处理（只有当前文件完全处理完才记录）
             recorder.add_record(gz_file.name, dataset_type)
@@ -252,16 +232,42 @@ def import_dataset_gz(dataset_key, cursor, conn):
     print(f"\n✅ 导入完成: {total_records:,}条 | 耗时: {elapsed:.1f}秒 | 速度: {speed:.0f}条/秒")
     recorder.close()
 
-def insert_batch(cursor, table_name, data_list):
-    """批量插入数据（corpusid + data）"""
-    from io import StringIO
+def iter_gz_records(f):
+    """逐行解析 gz 文件，产出 (corpusid, 整行JSON字节)，跳过空行和解析失败的行"""
+    for line in f:
+        try:
+            line_stripped = line.strip()
+            if not line_stripped:
+                continue
+            
+            # 直接从行字节提取corpusid（s2orc/embedding 行很大，无需整行解析）
+            corpusid = extract_corpusid(line_stripped)
+            
+            # 检查 corpusid 是否存在，存储整行JSON数据
+            if corpusid is not None:
+                yield corpusid, line_stripped
+        except:
+            continue
+
+def insert_batch(cursor, table_name, rows):
+    """批量插入数据（corpusid + data），返回插入的记录数"""
+    if not COPY_BINARY:
+        return insert_batch_text(cursor, table_name, list(rows))
+    
+    stream = BinaryCopyStream(rows)
+    cursor.copy_expert(copy_sql(table_name), stream, size=COPY_READ_SIZE)
+    return stream.row_count
+
+def insert_batch_text(cursor, table_name, data_list):
+    """使用 TEXT 格式 COPY 批量插入数据（调试用）"""
     buffer = StringIO()
     for corpusid, data in data_list:
         # 转义特殊字符
-        data_escaped = data.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+        data_escaped = data.decode('utf-8').replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
         buffer.write(f"{corpusid}\t{data_escaped}\n")
     buffer.seek(0)
     cursor.copy_from(buffer, table_name, columns=('corpusid', 'data'))
+    return len(data_list)
 
 # =============================================================================
 # 阶段2：创建索引
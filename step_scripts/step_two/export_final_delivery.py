@@ -11,6 +11,7 @@
 
 import sys
 import os
+import re
 import json
 import time
 import uuid
@@ -21,8 +22,8 @@ from datetime import datetime
 from multiprocessing import Process, Queue, Manager, Value, Lock
 from queue import Empty
 
+import orjson
 import psycopg2
-from psycopg2.extras import DictCursor
 
 # 添加项目根目录到路径
 sys.path.insert(0, str(Path(__file__).parent))
@@ -37,6 +38,13 @@ NUM_WORKERS = 6  # 6个worker进程
 OUTPUT_DIR = r"E:\final_delivery"  # 输出目录
 SQLITE_DB = r"E:\sqlite\export_progress.db"  # SQLite进度数据库
 
+# 每批按 corpusid 查询的基础表，及其预编译语句名前缀（语句名为 {前缀}_{表名}）
+BASE_TABLES = ('papers', 'abstracts', 'tldrs')
+BASE_QUERY_STMT = "base_query"
+
+# Writer 每累积多少行调用一次 writelines
+WRITE_CHUNK_LINES = 1024
+
 # 队列大小限制
 TASK_QUEUE_SIZE = 8
 RESULT_QUEUE_SIZE = 4
@@ -49,16 +57,26 @@ LOG_FILE = 'export_final_delivery.log'
 # JSON清理工具
 # =============================================================================
 
-_CONTROL_CHARS = dict.fromkeys(range(32))
-_CONTROL_CHARS.update(dict.fromkeys(range(127, 160)))
-_TRANSLATION_TABLE = str.maketrans(_CONTROL_CHARS)
+# 控制字符 U+0000-U+001F、U+007F-U+009F（删除）
+# 用正则字符类整段替换：C 层扫描，比按字符查 dict 的 str.translate 快数倍；无匹配时直接返回原字符串
+_CONTROL_CHARS_RE = re.compile('[\x00-\x1f\x7f-\x9f]')
 
 def safe_json_loads(json_str: str) -> dict:
-    """安全解析JSON字符串"""
+    """安全解析JSON字符串（orjson 解析；其拒绝的非严格 JSON（如 NaN）回退标准库）"""
     if not json_str:
         return {}
-    cleaned = json_str.translate(_TRANSLATION_TABLE)
-    return json.loads(cleaned)
+    cleaned = _CONTROL_CHARS_RE.sub('', json_str)
+    try:
+        return orjson.loads(cleaned)
+    except orjson.JSONDecodeError:
+        return json.loads(cleaned)
+
+def dump_json_line(record: dict) -> bytes:
+    """序列化一条记录为 UTF-8 JSON 行（orjson；其拒绝的值（如超过 64 位的整数）回退标准库）"""
+    try:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    except orjson.JSONEncodeError:
+        return json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
 
 # =============================================================================
 # 日志配置
@@ -84,6 +102,11 @@ def setup_logger(name: str, log_file: str = None, console_output: bool = True, e
         file_handler.setFormatter(formatter)
         logger.addHandler(file_handler)
     
+    # 没有任何输出目标（Worker/Writer 默认不写文件也不打印）时 INFO 记录只会被丢弃：
+    # 提高级别让 logger.info 在 isEnabledFor 处直接返回，不再构造 LogRecord；WARNING 以上仍输出到 stderr
+    if not logger.handlers:
+        logger.setLevel(logging.WARNING)
+    
     return logger
 
 logger = setup_logger('main', LOG_FILE, console_output=True, enable_file=ENABLE_FILE_LOGGING)
@@ -100,6 +123,12 @@ class ExportProgressRecorder:
     def __init__(self, db_path: str):
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
         self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # WAL + synchronous=NORMAL：每批一次的提交只追加 WAL，不再每次 fsync 主库文件
+        # （仍逐批提交：已写出的文件必须立即记录，否则续传时会以新文件名重复导出）
+        self.conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+        )
         self._init_database()
     
     def _init_database(self):
@@ -148,21 +177,26 @@ class ExportProgressRecorder:
 # 数据查询函数
 # =============================================================================
 
-def get_corpus_ids_batch(conn, offset: int, batch_size: int) -> List[int]:
-    """从 full_corpusid 表获取一批 corpusid（按 corpusid 顺序）"""
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT corpusid 
-            FROM full_corpusid 
-            ORDER BY corpusid
-            LIMIT %s OFFSET %s
-        """, (batch_size, offset))
-        
-        results = cursor.fetchall()
-        return [row[0] for row in results]
-    finally:
-        cursor.close()
+def open_corpus_id_stream(conn, offset: int):
+    """
+    打开 full_corpusid 的服务端游标（按 corpusid 顺序，从第 offset 条开始）
+    
+    整个导出只扫描一次索引；每批用 get_corpus_ids_batch 取下一段，
+    不再每批执行 LIMIT/OFFSET（OFFSET 越大，每次跳过的行越多）
+    """
+    cursor = conn.cursor(name='full_corpusid_stream')
+    cursor.execute("""
+        SELECT corpusid 
+        FROM full_corpusid 
+        ORDER BY corpusid
+        OFFSET %s
+    """, (offset,))
+    return cursor
+
+
+def get_corpus_ids_batch(id_cursor, batch_size: int) -> List[int]:
+    """从 corpusid 服务端游标取下一批 corpusid（一次 FETCH）"""
+    return [row[0] for row in id_cursor.fetchmany(batch_size)]
 
 
 def get_total_corpusid_count(conn) -> int:
@@ -175,25 +209,34 @@ def get_total_corpusid_count(conn) -> int:
         cursor.close()
 
 
+def prepare_base_queries(conn):
+    """在连接上为各基础表 PREPARE 一次范围查询语句（之后每批只 EXECUTE，跳过解析）"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("\n".join(
+            f"PREPARE {BASE_QUERY_STMT}_{table_name} (bigint, bigint) AS "
+            f"SELECT corpusid, data FROM {table_name} WHERE corpusid BETWEEN $1 AND $2;"
+            for table_name in BASE_TABLES
+        ))
+    finally:
+        cursor.close()
+
+
 def batch_query_table(conn, table_name: str, corpus_ids: List[int], logger=None, batch_id=None) -> Dict[int, str]:
-    """批量查询表数据（范围查询优化版本）"""
+    """批量查询表数据（范围查询，需先在该连接上 prepare_base_queries）"""
     if not corpus_ids:
         return {}
     
     func_start = time.time()
     
-    # 获取ID范围
+    # 获取ID范围（批次是有序 corpusid 流的连续切片，范围查询不会多取）
     min_id = min(corpus_ids)
     max_id = max(corpus_ids)
     
     cursor = conn.cursor()
     try:
         execute_start = time.time()
-        cursor.execute(f"""
-            SELECT corpusid, data 
-            FROM {table_name} 
-            WHERE corpusid BETWEEN %s AND %s
-        """, (min_id, max_id))
+        cursor.execute(f"EXECUTE {BASE_QUERY_STMT}_{table_name}(%s, %s)", (min_id, max_id))
         execute_elapsed = time.time() - execute_start
         
         fetchall_start = time.time()
@@ -224,15 +267,8 @@ def batch_query_authors(conn, author_ids: List[str], logger=None, batch_id=None)
     
     func_start = time.time()
     
-    author_ids_int = []
-    for aid in author_ids:
-        if aid:
-            try:
-                author_ids_int.append(int(aid))
-            except (ValueError, TypeError):
-                continue
-    
-    author_ids_int.sort()
+    # authorId 几乎都是纯数字字符串：isdecimal 预先筛掉非法值，免去逐个 try/except；集合去重后排序
+    author_ids_int = sorted({int(aid) for aid in author_ids if aid and aid.isdecimal()})
     
     if not author_ids_int:
         return {}
@@ -297,26 +333,37 @@ def batch_query_venues(conn, venue_ids: List[str]) -> Dict[str, dict]:
 # 数据合并处理
 # =============================================================================
 
+# 空基础结构模板（字段顺序即输出顺序）；可变的 dict/list 字段在 create_empty_base_structure 中逐条新建
+_EMPTY_BASE_TEMPLATE = {
+    "corpusid": None,
+    "externalids": None,
+    "externalIds": None,
+    "url": None,
+    "title": None,
+    "authors": None,
+    "venue": None,
+    "year": None,
+    "referenceCount": 0,
+    "citationCount": 0,
+    "influentialCitationCount": 0,
+    "isOpenAccess": False,
+    "s2FieldsOfStudy": None,
+    "publicationTypes": None,
+    "publicationDate": None,
+    "journal": None
+}
+
+
 def create_empty_base_structure(corpusid: int) -> dict:
-    """创建空的基础结构"""
-    return {
-        "corpusid": corpusid,
-        "externalids": {},
-        "externalIds": {},
-        "url": None,
-        "title": None,
-        "authors": [],
-        "venue": None,
-        "year": None,
-        "referenceCount": 0,
-        "citationCount": 0,
-        "influentialCitationCount": 0,
-        "isOpenAccess": False,
-        "s2FieldsOfStudy": [],
-        "publicationTypes": [],
-        "publicationDate": None,
-        "journal": None
-    }
+    """创建空的基础结构（复制模板，只新建可变字段）"""
+    base = _EMPTY_BASE_TEMPLATE.copy()
+    base["corpusid"] = corpusid
+    base["externalids"] = {}
+    base["externalIds"] = {}
+    base["authors"] = []
+    base["s2FieldsOfStudy"] = []
+    base["publicationTypes"] = []
+    return base
 
 
 def normalize_field_names(data: dict) -> dict:
@@ -390,7 +437,7 @@ def merge_base_data(
         else:
             base['tldr'] = None
         
-        # 添加预留字段
+        # 添加预留字段（逐个 setdefault：缺失字段按此顺序追加到输出；实测比模板 dict 合并 / 循环补齐都快）
         base.setdefault('paperId', "")
         base.setdefault('externalIds', {})
         base.setdefault('fieldsOfStudy', [])
@@ -421,16 +468,11 @@ def merge_base_data(
         if base.get('publicationTypes') is None:
             base['publicationTypes'] = []
         
-        # 确保 externalids 和 externalIds 同时存在
-        if 'externalids' in base and 'externalIds' not in base:
-            base['externalIds'] = base['externalids']
-        elif 'externalIds' in base and 'externalids' not in base:
+        # 确保 externalids 和 externalIds 同时存在（上面的 setdefault 已保证 externalIds 存在）
+        if 'externalids' not in base:
             base['externalids'] = base['externalIds']
-        elif 'externalids' not in base and 'externalIds' not in base:
-            base['externalids'] = {}
-            base['externalIds'] = {}
         
-        base['fieldsOfStudy'] = base.get('s2FieldsOfStudy', [])
+        base['fieldsOfStudy'] = base['s2FieldsOfStudy']
         
         merged_results[corpusid] = base
     
@@ -515,8 +557,11 @@ def worker_process(
         local_config = get_db_config('machine0')
         local_conn = psycopg2.connect(**local_config)
         local_cursor = local_conn.cursor()
-        local_cursor.execute("SET work_mem = '256MB'")
+        # 每批查询计划代价高会触发 JIT 编译（每条语句数十至数百毫秒），对反复执行的批量查询关闭
+        # 预编译语句执行 5 次后可能切换为通用计划，而通用计划无法在规划期按参数裁剪分区，强制每次按实际范围规划
+        local_cursor.execute("SET work_mem = '256MB'; SET jit = off; SET plan_cache_mode = force_custom_plan")
         local_cursor.close()
+        prepare_base_queries(local_conn)
         
         worker_logger.info(f"Worker-{worker_id} connected to local database")
     except Exception as e:
@@ -535,15 +580,10 @@ def worker_process(
                 worker_logger.info(f"Worker-{worker_id} received stop signal")
                 break
             
-            offset, batch_size = task
+            # 1. corpus_ids 由主进程从服务端游标顺序读取后随任务下发
+            offset, corpus_ids = task
             batch_start_time = time.time()
-            worker_logger.info(f"Worker-{worker_id} ========== START Batch offset={offset} ==========")
-            
-            # 1. 获取 corpus_ids
-            step_start = time.time()
-            corpus_ids = get_corpus_ids_batch(local_conn, offset, batch_size)
-            step_elapsed = time.time() - step_start
-            worker_logger.info(f"Worker-{worker_id} [Step1-GetCorpusIDs] offset={offset}, count={len(corpus_ids) if corpus_ids else 0}, time={step_elapsed:.3f}s")
+            worker_logger.info(f"Worker-{worker_id} ========== START Batch offset={offset}, count={len(corpus_ids)} ==========")
             
             if not corpus_ids:
                 worker_logger.warning(f"Worker-{worker_id} no data for offset={offset}")
@@ -678,13 +718,19 @@ def writer_process(
             
             try:
                 file_write_start = time.time()
-                with open(filepath, 'w', encoding='utf-8', buffering=16777216) as f:  # 16MB缓冲
+                # 二进制写入：orjson 直接产出 UTF-8 字节，省去 str 拼接与编码
+                # 注意输出格式与 json.dumps(..., ensure_ascii=False) 不同：分隔符紧凑（"," / ":"），NaN/Infinity 写为 null
+                with open(filepath, 'wb', buffering=16777216) as f:  # 16MB缓冲
+                    lines = []
                     for corpusid in corpus_ids:
                         if corpusid not in merged_results:
                             raise Exception(f"Missing data for corpusid {corpusid}")
                         
-                        json_line = json.dumps(merged_results[corpusid], ensure_ascii=False)
-                        f.write(json_line + '\n')
+                        lines.append(dump_json_line(merged_results[corpusid]))
+                        if len(lines) >= WRITE_CHUNK_LINES:
+                            f.writelines(lines)
+                            lines.clear()
+                    f.writelines(lines)
                 file_write_elapsed = time.time() - file_write_start
                 
                 file_size_mb = os.path.getsize(filepath) / (1024 * 1024)
@@ -838,6 +884,8 @@ def main():
     
     # 主循环
     current_offset = already_processed  # 从已处理的数量开始
+    id_cursor = open_corpus_id_stream(local_conn, current_offset)
+    next_ids = None  # 已取出但尚未成功放入任务队列的一批 corpusid
     total_processed = already_processed
     overall_start_time = time.time()
     pending_batches = {}  # {first_corpusid: batch_size}
@@ -852,11 +900,17 @@ def main():
                 if current_offset >= total_count:
                     break
                 
+                if next_ids is None:
+                    next_ids = get_corpus_ids_batch(id_cursor, BATCH_SIZE)
+                if not next_ids:
+                    break
+                
                 try:
-                    task_queue.put((current_offset, BATCH_SIZE), timeout=1)
+                    task_queue.put((current_offset, next_ids), timeout=1)
                     # 暂时使用offset作为key，后续会更新为实际的first_corpusid
                     pending_batches[current_offset] = BATCH_SIZE
                     current_offset += BATCH_SIZE
+                    next_ids = None
                 except Exception as e:
                     break
             